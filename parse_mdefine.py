@@ -4,6 +4,8 @@ Read xcm files with mdefine commands and convert to slang functions.
 
 Call as 'python parse_mdefine.py input_filename output_filename'
 The output filename is optional, defaulting to replacing the input file suffix with '.sl'.
+Several files can be converted in parallel, each to its default output name, with
+'python parse_mdefine.py --jobs 8 *.xcm'
 
 The list of additive fit functions may need extending for models outside than the base XSPEC set.
 Functions defined and then used later in the same file are added automatically.
@@ -18,141 +20,176 @@ ISIS> require("converted_xcm_file.sl");
 ISIS> fit_fun("my_mdefine_function");
 etc.
 
+For bulk conversions the module can optionally be compiled with Cython, without any source changes:
+
+$ cythonize -i -3 parse_mdefine.py
+
+The compiled extension is then used in preference to this file when imported,
+e.g. 'from parse_mdefine import convert_mdefine_file'; without Cython everything runs as plain Python.
+
 '''
 
 import re
-import numpy as np
+import functools
 
 ## List of mathematical (not fitting) functions available to mdefine:
 special_functions  = ['exp', 'sin', 'cos', 'tan', 'sinh', 'cosh', 'tanh', 'sqrt', 'abs', \
     'asin', 'acos', 'atan' , 'asinh', 'acosh', 'atanh', 'sind', 'cosd', 'tand', \
         'heaviside', 'boxcar', 'sign', 'mean', 'atan2', 'erf', 'erfc', 'log', 'log10', \
-            'gamma', 'min',' max', 'smin', 'smax']
+            'gamma', 'min', 'max', 'smin', 'smax']
 ## List of intrinsic XSPEC additive fit functions:
 additive_functions = ['agauss', 'c6vmekl', 'eqpair', 'nei', 'rnei', 'vraymond', 'agnsed', 'carbatm', 'eqtherm', 'nlapec', 'sedov', 'vrnei', 'agnslim', 'cemekl', 'equil', 'npshock', 'sirf', 'vsedov', 'apec', 'cevmkl', 'expdec', 'nsa', 'slimbh', 'vtapec', 'bapec', 'cflow', 'ezdiskbb', 'nsagrav', 'smaug', 'vvapec', 'bbody', 'compLS', 'gadem', 'nsatmos', 'snapec', 'vvgnei', 'bbodyrad', 'compPS', 'gaussian', 'nsmax', 'srcut', 'vvnei', 'bexrav', 'compST', 'gnei', 'nsmaxg', 'sresc', 'vvnpshock', 'bexriv', 'compTT', 'grad', 'nsx', 'ssa', 'vvpshock', 'bkn2pow', 'compbb', 'grbcomp', 'nteea', 'step', 'vvrnei', 'bknpower', 'compmag', 'grbjet', 'nthComp', 'tapec', 'vvsedov', 'bmc', 'comptb', 'grbm', 'optxagn', 'vapec', 'vvtapec', 'bremss', 'compth', 'hatm', 'optxagnf', 'vbremss', 'vvwdem', 'brnei', 'cph', 'jet', 'pegpwrlw', 'vcph', 'vwdem', 'btapec', 'cplinear', 'kerrbb', 'pexmon', 'vequil', 'wdem', 'bvapec', 'cutoffpl', 'kerrd', 'pexrav', 'vgadem', 'zagauss', 'bvrnei', 'disk', 'kerrdisk', 'pexriv', 'vgnei', 'zbbody', 'bvtapec', 'diskbb', 'kyrline', 'plcabs', 'vmcflow', 'zbknpower', 'bvvapec', 'diskir', 'laor', 'posm', 'vmeka', 'zbremss', 'bvvrnei', 'diskline', 'laor2', 'powerlaw', 'vmekal', 'zcutoffpl', 'bvvtapec', 'diskm', 'logpar', 'pshock', 'vnei', 'zgauss', 'bwcycl', 'disko', 'lorentz', 'qsosed', 'vnpshock', 'zkerrbb', 'c6mekl', 'diskpbb', 'meka', 'raymond', 'voigt', 'zlogpar', 'c6pmekl', 'diskpn', 'mekal', 'redge', 'vpshock', 'zpowerlw', 'c6pvmkl', 'eplogpar', 'mkcflow', 'refsch']
 
+## Sets for fast membership tests (additive functions defined in mdefine statements are added as they are read;
+## additive_functions may still be extended after import, it is merged in when each line is converted):
+_SPECIAL  = frozenset(special_functions)
+_ADDITIVE = set(additive_functions)
+
+## ISIS expression substituted for the energy, e/E (central energy):
+_E_REPLACEMENT = '(6.19920995*(lo+hi)/lo/hi)'
+#(central wavelength):
+#_E_REPLACEMENT = '(24.7968398/(lo+hi))'
+## Maximum length of output lines before they are divided:
+_LINE_LIMIT = 72
+
+## Precompiled patterns used by interpret_line:
+_WORD_SPLIT = re.compile(r'\W')
+_E_VAR      = re.compile(r'\b[eE]\b')
+_WRAP_RE    = re.compile(r'([+*])')
+
+@functools.lru_cache(maxsize=None)
+def _wordre(name):
+    '''
+    Compiled pattern matching name as a whole word
+    '''
+    return re.compile(rf'\b{name}\b')
+
+## Single-token rewrites from XSPEC to S-Lang syntax, applied in one pass:
+_TOKEN_RE = re.compile(r'\*\s*\*|\b(log|ln|smin|smax)\b\s*\(')
+_TOKEN_REPLACEMENTS = {'log':'log10(', 'ln':'log(', 'smin':'min(', 'smax':'max('}
+
+def _replace_token(match):
+    '''
+    Replacement for a single _TOKEN_RE match
+    '''
+    if match.group(1) is None:
+        return '^'
+    return _TOKEN_REPLACEMENTS[match.group(1)]
+
+def _matching_bracket(expr, open_idx):
+    '''
+    Index of the ')' closing the '(' at open_idx, jumping between brackets with str.find
+    '''
+    bracket_level = 1
+    i = open_idx+1
+    while bracket_level:
+        next_open  = expr.find('(', i)
+        next_close = expr.find(')', i)
+        if next_close == -1:
+            raise ValueError('Unbalanced brackets in expression: "'+expr+'"')
+        if next_open != -1 and next_open < next_close:
+            bracket_level += 1
+            i = next_open+1
+        else:
+            bracket_level -= 1
+            i = next_close+1
+    return i-1
+
+def _wrap_calls(expr, name, prefix, suffix):
+    '''
+    Replace each call 'name(args)' in expr with prefix+args+suffix.
+    Calls nested inside the arguments are rewritten in the same left-to-right pass.
+    expr itself is never modified; slices of it are collected and joined once.
+    '''
+    parts  = []
+    closes = [] # Indices of pending closing brackets, innermost last
+    pos = 0
+    for match in _wordre(name).finditer(expr):
+        # Close any calls which end before this one starts:
+        while closes and closes[-1] < match.start():
+            close = closes.pop()
+            parts += [expr[pos:close], suffix]
+            pos = close+1
+        # Find string of the function arguments:
+        open_idx = expr.index('(', match.end())
+        parts += [expr[pos:match.start()], prefix]
+        pos = open_idx+1
+        closes.append(_matching_bracket(expr, open_idx))
+    while closes:
+        close = closes.pop()
+        parts += [expr[pos:close], suffix]
+        pos = close+1
+    parts.append(expr[pos:])
+    return ''.join(parts)
+
 def interpret_line(line,out):
     '''
-    Convert an XSPEC mdefine model to ISIS/S-Lang syntax
+    Convert an XSPEC mdefine model to ISIS/S-Lang syntax and write it to out
+    '''
+    _ADDITIVE.update(additive_functions)
+    out.write(_translate_line(line, _ADDITIVE))
+
+def _translate_line(line, additive):
+    '''
+    Convert an XSPEC mdefine model to ISIS/S-Lang syntax, returning the S-Lang block
+    additive is the set of additive function names, extended if this model is additive
     '''
     
     ### Separate line into components:
 
+    head, _, tail = line.partition(':')
+    tokens = head.split()
     ## Function name
-    func_name = line.split(' ')[1]
+    func_name = tokens[1]
     ## Function expression
-    func_expr = ' '.join(line.split(':')[0].split(' ')[2:])
+    func_expr = ' '.join(tokens[2:])
     ## Model type (add, mul, con); default to add if not given
-    if len(line.split(':'))==1:
-        mtype = 'add'
-    else:
-        mtype = line.split(':')[-1].strip()
+    mtype = tail.strip() or 'add'
     
     if mtype == 'add':
-        additive_functions.append(func_name)
+        additive.add(func_name)
     
     ### Process XSPEC function expression:
     
-    ## Replace '**' for exponentiation with '^':
-    re.sub(r'\*\s*\*','^',func_expr)
-    
-    ## Correct logarithm bases:
-    re.sub(r'\blog\b\s*\(','log10(',func_expr)
-    re.sub(r'\bln\b\s*\(' ,'log('  ,func_expr)
-    
     ## Change vector min/max syntax
     
     ## For binary min/max, put the two arguments in an array:
     for sub_func_name in ['min','max']:
-            match = True
-            new_func_expr = ''
-        
-            ##Find instance of the function:
-            match = re.search(r'\b'+sub_func_name+r'\b', func_expr)
-            while match:         
-                
-                # Move this segment to new string
-                new_func_expr += func_expr[:match.start()]+sub_func_name+'(['
-                func_expr = func_expr[match.end():]
-                # Find string of the function arguments:                                
-                func_expr = func_expr[re.search(r'\(',func_expr).end():]
-                                                                                   
-                i=0
-                bracket_level = 1
-                while bracket_level > 0:
-                    if func_expr[i]==r'(':
-                        bracket_level+=1
-                    elif func_expr[i]==r')':
-                        bracket_level-=1
-                    i+=1
-                func_expr=func_expr[:i-1]+'])'+func_expr[i:]
-                                
-                ##Find next instance of the function:
-                match = re.search(r'\b'+sub_func_name+r'\b', func_expr)
-                                
-            func_expr = new_func_expr + func_expr
-    
-    re.sub(r'\bsmin\b\s*\(','min(',func_expr)
-    re.sub(r'\bsmax\b\s*\(','max(',func_expr)
+        func_expr = _wrap_calls(func_expr, sub_func_name, sub_func_name+'([', '])')
+    
+    ## Replace '**' for exponentiation with '^', correct logarithm bases
+    ## and rename vector smin/smax, all in a single pass:
+    func_expr = _TOKEN_RE.sub(_replace_token, func_expr)
     
     ## Extract names of existing functions:
-    before_bracket=[re.split('\W', _)[-1] for _ in func_expr.split('(') ]
+    before_bracket=[_WORD_SPLIT.split(_)[-1] for _ in func_expr.split('(')[:-1] ]
     sub_func_names = [ _ for _ in before_bracket if _!='']
     
+    sub_func_names_set = set(sub_func_names)
+    
     ## Extract parameters (anything else that is not the energy specifier):
-    words = [_ for _ in re.split('\W',func_expr) if _!='']
-    words = [_ for _ in words if not re.match('[0-9]',_[0]) ]
-    pars,inds = np.unique([ _ for _ in words if _ not in sub_func_names and _!='e' and _!='E' ], return_index=True)
-    # Put parameters in order used in original function:
-    pars     = list(pars[np.argsort(inds)])
+    words = [_ for _ in _WORD_SPLIT.split(func_expr) if _ and not _[0].isdigit()]
+    # Remove duplicates, keeping parameters in order used in original function:
+    pars = list(dict.fromkeys(_ for _ in words if _ not in sub_func_names_set and _ not in ('e','E')))
     
     ### Make S-Lang expression by modifying XSPEC syntax:
-        
-    ## Address subfunctions properly and give wavelengths to subfunctions:
-    for sub_func_name in np.unique(sub_func_names):
-        if sub_func_name not in special_functions:
-            match = True
-            new_func_expr = ''
-        
-            ##Find instance of the function:
-            match = re.search(r'\b'+sub_func_name+r'\b', func_expr)
-            while match:         
-                
-                # Move this segment to new string
-                new_func_expr += func_expr[:match.start()]+'eval_fun2(&'+sub_func_name+',lo,hi, ['
-                func_expr = func_expr[match.end():]
-                # Find string of the function arguments:
-                
-                # Add the normalisation for additive models:
-                if sub_func_name in additive_functions:
-                    new_func_expr += '1, '
-                
-                func_expr = func_expr[re.search(r'\(',func_expr).end():]
-                                                                                   
-                i=0
-                bracket_level = 1
-                while bracket_level > 0:
-                    if func_expr[i]==r'(':
-                        bracket_level+=1
-                    elif func_expr[i]==r')':
-                        bracket_level-=1
-                    i+=1
-                func_expr=func_expr[:i-1] +'])'+ func_expr[i:]
-                
-                ##Find next instance of the function:
-                match = re.search(r'\b'+sub_func_name+r'\b', func_expr)
-                
-                
-            func_expr = new_func_expr + func_expr
-    
-    '''
-    Dealing with finding bin-integral quantities properly might need more care in the following two sections.
+    
+    '''
+    Dealing with finding bin-integral quantities properly might need more care in the energy conversion and the additive normalisation.
     '''
-        
-    ## Convert energy to ISIS expression (central energy):
-    func_expr = re.sub(r'\b(e|E)\b', '(6.19920995*(lo+hi)/lo/hi)', func_expr)
-    #(central wavelength):
-    #func_expr = re.sub(r'\b(e|E)\b', '(24.7968398/(lo+hi))', func_expr)
+    
+    ## Convert energy to ISIS expression (central energy).
+    ## Done before wrapping subfunctions, which only adds eval_fun2, lo, hi and function names, so the text scanned is shorter:
+    func_expr = _E_VAR.sub(_E_REPLACEMENT, func_expr)
+    
+    ## Address subfunctions properly and give wavelengths to subfunctions:
+    for sub_func_name in dict.fromkeys(sub_func_names):
+        if sub_func_name not in _SPECIAL:
+            prefix = 'eval_fun2(&'+sub_func_name+',lo,hi, ['
+            # Add the normalisation for additive models:
+            if sub_func_name in additive:
+                prefix += '1, '
+            func_expr = _wrap_calls(func_expr, sub_func_name, prefix, '])')
     
     ## Allow a normalisation for additive models:
     if mtype == 'add':
@@ -163,54 +200,125 @@ def interpret_line(line,out):
     ### Make a compliant .sl file:
     
     ## Divide function expression if lines are too long:
-    if len(func_expr)>72:
-        func_expr = ' +\n        '.join(func_expr.split('+'))
-        func_expr = ' *\n        '.join(func_expr.split('*'))
+    if len(func_expr)>_LINE_LIMIT:
+        func_expr = _WRAP_RE.sub(r' \1\n        ', func_expr)
     
     ## Declare all parameters as variable names:
     declare_variables = 'variable '+', '.join(pars)
-    if len(declare_variables)>72:
+    if len(declare_variables)>_LINE_LIMIT:
         declare_variables = 'variable '+', \n        '.join(pars)
     ## List of parameters for output:
     par_list = '["'+'","'.join(pars)+'"]'
     # Use separate lines if too long:
-    if len(par_list)>72:
+    if len(par_list)>_LINE_LIMIT:
         par_list =  '["'+'",\n        "'.join(pars)+'"]'
     
-    ### Write to file:
-    out.write('define '+func_name+'_fit(lo,hi,par)\n{\n')
-    out.write('    '+declare_variables+';\n')
-    #out.write('    print("'+func_name+'");\n')
-    for par,i in zip(pars,range(len(pars))):
-        out.write('    '+par+' = par['+str(i)+'];\n')
-    out.write('\n    return '+func_expr+';\n};\n\n')
-    out.write('add_slang_function("'+func_name+'", '+par_list+');\n\n')
+    ### Make output block:
+    chunks = ['define '+func_name+'_fit(lo,hi,par)\n{\n']
+    chunks.append('    '+declare_variables+';\n')
+    #chunks.append('    print("'+func_name+'");\n')
+    chunks.append(''.join(f'    {par} = par[{i}];\n' for i,par in enumerate(pars)))
+    chunks.append('\n    return '+func_expr+';\n};\n\n')
+    chunks.append('add_slang_function("'+func_name+'", '+par_list+');\n\n')
+    return ''.join(chunks)
     
+def convert_mdefine_stream(lines, out):
+    '''
+    Convert an iterable of xcm lines (e.g. an open file), writing the S-Lang output to out
+    '''
+    ## Additive functions for this stream only, so conversions are independent
+    ## (of each other and of interpret_line calls):
+    additive = set(additive_functions)
+    ## Translations of mdefine lines already seen, for repeated definitions
+    ## (only valid while the set of additive functions is unchanged):
+    seen = {}
+    out.write('\n%%% Automatically translated by parse_mdefine (D. J. K. Buisson) %%%\n\n')
+    for line in lines:
+        line = line.rstrip('\n')
+        tok = line.split(None,1)
+        if not tok:
+            pass
+        elif tok[0] == '#':
+            out.write('%'+line+'\n')
+        elif tok[0] == 'mdefine':
+            key = line.strip()
+            block = seen.get(key)
+            if block is None:
+                n_additive = len(additive)
+                block = _translate_line(key, additive)
+                # A new additive model changes how earlier lines translate:
+                if len(additive) != n_additive:
+                    seen.clear()
+                seen[key] = block
+            out.write(block)
+        else:
+            print('Failed to parse line: "'+line+'"')
+
 def convert_mdefine_file(input_xcm_file, output_sl_file):
     
-    out = open(output_sl_file,'w')
-    out.write('\n%%% Automatically translated by parse_mdefine (D. J. K. Buisson) %%%\n\n')
     with open(input_xcm_file,'r') as f:
-        for line in f:
-            if len(line.split())<1:
-                pass
-            elif line.split()[0] == '#':
-                out.write('%'+line)
-            elif line.split()[0] == 'mdefine':
-                interpret_line(line,out)
-            else:
-                print('Failed to parse line: "'+line+'"')
-    out.close()
+        lines = f.read().splitlines()
+    with open(output_sl_file,'w',buffering=1<<16) as out:
+        convert_mdefine_stream(lines, out)
+
+def _default_output_name(input_xcm_file):
+    '''
+    Output filename made by replacing the input file suffix with '.sl'
+    '''
+    return '.'.join(input_xcm_file.split('.')[:-1])+'.sl'
+
+def _one_file(input_xcm_file):
+    '''
+    Convert a single xcm file to its default output name (worker for convert_many)
+    '''
+    convert_mdefine_file(input_xcm_file, _default_output_name(input_xcm_file))
+
+def convert_many(input_xcm_files, nproc=None):
+    '''
+    Convert several xcm files in parallel, each to its default output name
+    nproc defaults to the number of CPUs
+    '''
+    from multiprocessing import Pool
+    with Pool(nproc) as pool:
+        pool.map(_one_file, input_xcm_files)
     
 if __name__ == "__main__":
-    from os import sys
-    ## Get filenames
-    input_xcm_file = sys.argv[1]
-    try:
-        output_sl_file = sys.argv[2]
-    except:
-        ## Make output name if not given
-        output_sl_file = '.'.join(input_xcm_file.split('.')[:-1])+'.sl'
-    
-    ## Make output
-    convert_mdefine_file(input_xcm_file, output_sl_file)
+    import argparse
+    import os
+    parser = argparse.ArgumentParser(description='Convert XSPEC mdefine models in xcm files to S-Lang functions.')
+    parser.add_argument('files', nargs='+', help='input_filename [output_filename], or several input files (no output filenames) with --jobs')
+    parser.add_argument('-j', '--jobs', type=int, help='convert all given input files using this many processes')
+    args = parser.parse_args()
+    
+    if args.jobs is not None:
+        if args.jobs < 1:
+            parser.error('--jobs must be at least 1')
+        ## Output names are made from the inputs, so reject anything that looks like an output filename:
+        outputs = [_ for _ in args.files if _.endswith('.sl')]
+        if outputs:
+            parser.error('output filenames cannot be given with --jobs: '+', '.join(outputs))
+        missing = [_ for _ in args.files if not os.path.isfile(_)]
+        if missing:
+            parser.error('input file not found: '+', '.join(missing))
+        no_suffix = [_ for _ in args.files if not os.path.splitext(_)[1]]
+        if no_suffix:
+            parser.error('input files need a suffix to make the output filename: '+', '.join(no_suffix))
+        ## Each worker must write to a different output file:
+        output_names = [os.path.abspath(_default_output_name(_)) for _ in args.files]
+        duplicates = [_ for _,name in zip(args.files, output_names) if output_names.count(name) > 1]
+        if duplicates:
+            parser.error('input files would share an output filename: '+', '.join(duplicates))
+        convert_many(args.files, args.jobs)
+    elif len(args.files) > 2:
+        parser.error('give one input and optional output filename, or use --jobs for several files')
+    else:
+        ## Get filenames
+        input_xcm_file = args.files[0]
+        if len(args.files) == 2:
+            output_sl_file = args.files[1]
+        else:
+            ## Make output name if not given
+            output_sl_file = _default_output_name(input_xcm_file)
+        
+        ## Make output
+        convert_mdefine_file(input_xcm_file, output_sl_file)